@@ -1,10 +1,11 @@
+from asyncio import Semaphore, TaskGroup
 import inspect
 import random
 from enum import Enum, EnumType
 from logging import getLogger
 import re
 from types import NoneType, UnionType
-from typing import TYPE_CHECKING, Awaitable, Callable
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, NamedTuple
 
 from aiohttp import ClientSession
 from sechat import Room
@@ -27,7 +28,62 @@ ARGUMENT_TYPE_SIGNATURES = {
     list[str]: ArgumentType.STRARRAY,
 }
 
+# values that commands can request by parameter name, derived from the triggering message
+CONTEXT_PARAMETERS: dict[str, Callable[[MessageEvent], Any]] = {
+    "event": lambda event: event,
+}
+IGNORED_PARAMETERS = frozenset({"self", *CONTEXT_PARAMETERS})
+
 PREFIX = "!!/"
+MAX_CONCURRENT_COMMANDS = 8
+
+class CommandParameter(NamedTuple):
+    name: str
+    expected_type: ArgumentType
+    is_enum: bool
+    has_default: bool
+    default: Any
+    values: dict[str, Enum]
+    values_help: str
+
+class CommandSignature(NamedTuple):
+    name: str
+    parameters: tuple[CommandParameter, ...]
+    context_parameters: tuple[str, ...]
+
+def _command_signature(command_name: str, command: Callable) -> CommandSignature:
+    parameters = []
+    signature = inspect.signature(command)
+    for name, parameter in signature.parameters.items():
+        if name in IGNORED_PARAMETERS:
+            continue
+        annotation = parameter.annotation
+        is_enum = False
+        values: dict[str, Enum] = {}
+        if isinstance(annotation, EnumType):
+            expected_type = ArgumentType.FLAG
+            is_enum = True
+            values = {item.value: item for item in list(annotation) if isinstance(item, Enum)}
+        elif isinstance(annotation, UnionType):
+            assert annotation.__args__[1] == NoneType
+            assert parameter.default == None
+            expected_type = ARGUMENT_TYPE_SIGNATURES[annotation.__args__[0]]
+        else:
+            expected_type = ARGUMENT_TYPE_SIGNATURES[annotation]
+        parameters.append(CommandParameter(
+            name,
+            expected_type,
+            is_enum,
+            parameter.default is not parameter.empty,
+            parameter.default,
+            values,
+            "/".join(values.keys()),
+        ))
+    return CommandSignature(
+        command_name,
+        tuple(parameters),
+        tuple(name for name in CONTEXT_PARAMETERS if name in signature.parameters),
+    )
 
 class Commands:
     logger = getLogger("commands")
@@ -35,11 +91,16 @@ class Commands:
     def __init__(self, room: Room):
         self.room = room
         self.commands: dict[str, CommandTree] = {}
+        self.signatures: dict[Callable, CommandSignature] = {}
+        self.leaves: dict[tuple[str, ...], Callable] = {}
+        self.groups: dict[tuple[str, ...], tuple[str, ...]] = {}
+        self.command_slots = Semaphore(MAX_CONCURRENT_COMMANDS)
 
         for method_name, method in inspect.getmembers(self, inspect.ismethod):
             if not method_name.endswith("_command"):
                 continue
-            path = method_name.removesuffix("_command").split("_")
+            command_name = method_name.removesuffix("_command")
+            path = command_name.split("_")
             parent: dict[str, CommandTree] = self.commands
             while len(path) > 1:
                 node = path.pop(0)
@@ -53,24 +114,42 @@ class Commands:
             if leaf in parent:
                 raise Exception(f"A command or group named {leaf} already exists in {parent}")
             parent[leaf] = method
+            self.signatures[method] = _command_signature(command_name.replace("_", " "), method)
+        self.flatten_tree((), self.commands)
+
+    def flatten_tree(self, prefix: tuple[str, ...], tree: dict[str, CommandTree]):
+        self.groups[prefix] = tuple(tree.keys())
+        for name, node in tree.items():
+            if isinstance(node, dict):
+                self.flatten_tree((*prefix, name), node)
+            else:
+                self.leaves[(*prefix, name)] = node
 
     async def run(self):
-        async with ClientSession(self.room._session._base_url) as session:
+        async with ClientSession(self.room._session._base_url) as session, TaskGroup() as group:
             async for event in self.room.events():
                 match event:
                     case MessageEvent() if event.content.startswith(PREFIX) and len(event.content) > len(PREFIX):
-                        async with session.get(f"/message/{event.message_id}?plain=true") as response:
-                            content = (await response.text())
-                        match (await self.handle(event, list(parse_arguments(content.removeprefix(PREFIX))))):
-                            case str(message):
-                                await self.room.send(message, event.message_id)
-                            case (message, reply_to):
-                                await self.room.send(message, reply_to)
+                        await self.command_slots.acquire()
+                        group.create_task(self.fetch_and_handle(session, event))
+
+    async def fetch_and_handle(self, session: ClientSession, event: MessageEvent):
+        try:
+            async with session.get(f"/message/{event.message_id}?plain=true") as response:
+                content = (await response.text())
+            match (await self.handle(event, list(parse_arguments(content.removeprefix(PREFIX))))):
+                case str(message):
+                    await self.room.send(message, event.message_id)
+                case (message, reply_to):
+                    await self.room.send(message, reply_to)
+        except Exception:
+            self.logger.exception("Failed to handle command message %s", event.message_id)
+        finally:
+            self.command_slots.release()
 
 
     async def handle(self, event: MessageEvent, arguments: list["Argument"]):
-        self.logger.debug(f"Handling command: {arguments}")
-        command = self.commands
+        self.logger.debug("Handling command: %s", arguments)
         match arguments[0]:
             case (ArgumentType.ERROR, message):
                 return f"Parsing error: {message}"
@@ -78,95 +157,85 @@ class Commands:
                 pass
             case _:
                 return None
+        command = None
+        path: tuple[str, ...] = ()
         for index, argument in enumerate(arguments):
             if argument[0] != ArgumentType.FLAG:
                 break
-            if argument[1] not in command:
+            path = (*path, argument[1])
+            if (command := self.leaves.get(path)) is not None:
+                arguments = arguments[index + 1:]
+                break
+            if path not in self.groups:
                 if index == 0:
                     return f"There is no command named !!/{argument[1]}."
-                parent_name = " ".join(a[1] for a in arguments[:index] if a[0] == ArgumentType.FLAG)
                 return (
-                    f"The group !!/{parent_name} has no subcommand named \"{argument[1]}\". "
-                    f"Its subcommands are: {", ".join(command.keys())}"
+                    f"The group !!/{" ".join(path[:-1])} has no subcommand named \"{argument[1]}\". "
+                    f"Its subcommands are: {", ".join(self.groups[path[:-1]])}"
                 )
-            command = command[argument[1]]
-            if not isinstance(command, dict):
-                arguments = arguments[index + 1:]
-                break
-        if isinstance(command, dict):
-            parent_name = " ".join(a[1] for a in arguments if a[0] == ArgumentType.FLAG)
-            return f"Subcommands of !!/{parent_name} are: {", ".join(command.keys())}"
+        if command is None:
+            return f"Subcommands of !!/{" ".join(path)} are: {", ".join(self.groups[path])}"
         
-        argument_values = []
-        parameters = inspect.signature(command).parameters
-        for name, parameter in parameters.items():
-            if name in ("self", "event"):
-                continue
-            if isinstance(parameter.annotation, EnumType):
-                expected_type = ArgumentType.FLAG
-            elif isinstance(parameter.annotation, UnionType):
-                assert parameter.annotation.__args__[1] == NoneType
-                assert parameter.default == None
-                expected_type = ARGUMENT_TYPE_SIGNATURES[parameter.annotation.__args__[0]]
-            else:
-                expected_type = ARGUMENT_TYPE_SIGNATURES[parameter.annotation]
-            if len(arguments):
-                match arguments.pop(0):
+        argument_values = {}
+        signature = self.signatures[command]
+        if len(arguments) > len(signature.parameters):
+            return f"Too many arguments supplied; !!/{signature.name} takes at most {len(signature.parameters)}"
+        for index, parameter in enumerate(signature.parameters):
+            if index < len(arguments):
+                match arguments[index]:
                     case (ArgumentType.ERROR, message):
                         return f"Parsing error: {message}"
-                    case (ArgumentType.FLAG, name) if expected_type == ArgumentType.FLAG:
-                        assert isinstance(parameter.annotation, EnumType)
-                        argument_values.append(parameter.annotation(name))
-                    case (argument_type, value) if expected_type == argument_type:
-                        argument_values.append(value)
+                    case (ArgumentType.FLAG, name) if parameter.is_enum:
+                        if (member := parameter.values.get(name)) is None:
+                            return (
+                                f"Invalid value supplied for argument `{parameter.name}`; "
+                                f"expected one of {parameter.values_help}"
+                            )
+                        argument_values[parameter.name] = member
+                    case (argument_type, value) if parameter.expected_type == argument_type:
+                        argument_values[parameter.name] = value
                     case (actual_type, _):
                         return (
-                            f"Incorrect type supplied for argument `{name}`; "
-                            f"expected **{expected_type.name}** but got **{actual_type.name}**"    
+                            f"Incorrect type supplied for argument `{parameter.name}`; "
+                            f"expected **{parameter.expected_type.name}** but got **{actual_type.name}**"    
                         )
-            elif parameter.default is not parameter.empty:
-                argument_values.append(parameter.default)
+            elif parameter.has_default:
+                argument_values[parameter.name] = parameter.default
             else:
-                return f"Argument `{name}` not provided, expected a value of type **{expected_type.name}**"
-        if "event" in parameters:
-            return await command(event, *argument_values)
-        return await command(*argument_values)
+                return f"Argument `{parameter.name}` not provided, expected a value of type **{parameter.expected_type.name}**"
+        for name in signature.context_parameters:
+            argument_values[name] = CONTEXT_PARAMETERS[name](event)
+        return await command(**argument_values)
 
     async def help_command(self, name: str):
         """Display parameters and help for a command."""
         if name == "me":
             return "I'd love to, but I don't have any limbs."
-        path = name.split(" ")
-        help_target = self.commands
+        path = tuple(name.split(" "))
+        help_target = None
         for index, segment in enumerate(path):
-            if segment not in help_target:
+            if (help_target := self.leaves.get(path[:index + 1])) is not None:
+                break
+            if path[:index + 1] not in self.groups:
                 if index == 0:
                     return f"There is no command named \"{segment}\"."
                 parent_name = " ".join(path[:index])
                 return (
                     f"The group \"{parent_name}\" has no subcommand named \"{segment}\". "
-                    f"Its subcommands are: {", ".join(help_target.keys())}"
+                    f"Its subcommands are: {", ".join(self.groups[path[:index]])}"
                 )
-            help_target = help_target[segment]
-            if not isinstance(help_target, dict):
-                break
-        if isinstance(help_target, dict):
+        if help_target is None:
             parent_name = " ".join(path)
-            return f"Subcommands of !!/{parent_name} are: {", ".join(help_target.keys())}"
+            return f"Subcommands of !!/{parent_name} are: {", ".join(self.groups[path])}"
         
         doc = help_target.__doc__ if help_target.__doc__ is not None else "(no help)"
         parameters = []
-        for parameter_name, parameter in inspect.signature(help_target).parameters.items():
-            if name in ("self", "event"):
-                continue
-            if isinstance(parameter.annotation, EnumType):
-                values = "/".join(item.value for item in list(parameter.annotation) if isinstance(item, Enum))
-                body = f"ENUM {parameter_name}: {values}"
-            elif isinstance(parameter.annotation, UnionType):
-                body = f"{ARGUMENT_TYPE_SIGNATURES[parameter.annotation.__args__[0]].name} {parameter_name}"
+        for parameter in self.signatures[help_target].parameters:
+            if parameter.is_enum:
+                body = f"ENUM {parameter.name}: {parameter.values_help}"
             else:
-                body = f"{ARGUMENT_TYPE_SIGNATURES[parameter.annotation].name} {parameter_name}"
-            if parameter.default != parameter.empty:
+                body = f"{parameter.expected_type.name} {parameter.name}"
+            if parameter.has_default:
                 if parameter.default == None:
                     parameters.append(f"[{body}]")
                 else:
@@ -1,8 +1,11 @@
 import re
 
 
+MARKDOWN_REGEX = re.compile(f"([{re.escape("_*`[]")}])")
+
+
 def escape_markdown(text: str) -> str:
-    return re.sub(f"([{re.escape("_*`[]")}])", r"\\\1", text)
+    return MARKDOWN_REGEX.sub(r"\\\1", text)
 
 
 def user_link(user: dict) -> str:
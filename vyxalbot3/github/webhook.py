@@ -1,46 +1,137 @@
+import inspect
 import re
-from collections.abc import Callable
+from collections.abc import Callable, Iterable
 from functools import wraps
 from logging import getLogger
 from pprint import pformat
-from typing import AsyncGenerator, Awaitable
+from typing import AsyncGenerator, Awaitable, cast
 
 from aiohttp.web import Request, Response
 from gidgethub import BadRequest, ValidationFailure
-from gidgethub.routing import Router
 from gidgethub.sansio import Event
 from sechat import Room
 
 from vyxalbot3.github.formatters import *
 
+VERSION_REGEX = re.compile(r"\d.*")
+
+type ActionFormatter = Callable[[dict, str, str, str], str]
+
+ISSUE_ACTIONS: dict[str, ActionFormatter] = {
+    "assigned": lambda data, sender, issue, repository: (
+        f"{sender} assigned {user_link(data["assignee"])} to issue {issue} in {repository}"
+    ),
+    "unassigned": lambda data, sender, issue, repository: (
+        f"{sender} unassigned {user_link(data["assignee"])} to issue {issue} in {repository}"
+    ),
+    "closed": lambda data, sender, issue, repository: (
+        f"{sender} closed issue {issue} as {data["issue"]["state_reason"]} in {repository}"
+    ),
+    "opened": lambda data, sender, issue, repository: f"{sender} opened issue {issue} in {repository}",
+    "reopened": lambda data, sender, issue, repository: f"{sender} reopened issue {issue} in {repository}",
+}
+
+PULL_REQUEST_ACTIONS: dict[str, ActionFormatter] = {
+    "assigned": lambda data, sender, pr, repository: (
+        f"{sender} assigned {user_link(data["assignee"])} to pull request {pr} in {repository}"
+    ),
+    "unassigned": lambda data, sender, pr, repository: (
+        f"{sender} unassigned {user_link(data["assignee"])} from pull request {pr} in {repository}"
+    ),
+    "closed": lambda data, sender, pr, repository: (
+        f"{sender} {"merged" if data["pull_request"]["merged"] else "closed"} "
+        f"pull request {pr} in {repository}"
+    ),
+    "ready_for_review": lambda data, sender, pr, repository: (
+        f"{sender} marked pull request {pr} in {repository} as ready for review"
+    ),
+    "opened": lambda data, sender, pr, repository: f"{sender} pull request opened {pr} in {repository}",
+    "reopened": lambda data, sender, pr, repository: f"{sender} pull request reopened {pr} in {repository}",
+    "enqueued": lambda data, sender, pr, repository: f"{sender} pull request enqueued {pr} in {repository}",
+}
+
+REVIEW_ACTIONS = {
+    "commented": "commented on",
+    "approved": "approved",
+    "changes_requested": "requested changes on",
+}
+
+type GeneratorHandler = Callable[[Event, Room], AsyncGenerator[str | tuple[str, int], int]]
+type CoroutineHandler = Callable[[Event, Room], Awaitable[str | tuple[str, int] | None]]
+type WebhookHandler = Callable[[Event, "GitHubWebhookReporter"], Awaitable[None]]
+
+ROUTES: dict[tuple[str, str | None], WebhookHandler] = {}
+
+def route(event: str, action: str | None = None) -> Callable[[WebhookHandler], WebhookHandler]:
+    def _register(handler: WebhookHandler) -> WebhookHandler:
+        if (event, action) in ROUTES:
+            raise Exception(f"A handler for {event} (action {action}) is already registered")
+        # handle_request only runs the most specific handler, so an event-wide handler
+        # would silently be skipped for actions which also have their own handler
+        if any(
+            registered_event == event and (registered_action is None) != (action is None)
+            for registered_event, registered_action in ROUTES
+        ):
+            raise Exception(f"{event} cannot have both event-wide and per-action handlers")
+        ROUTES[event, action] = handler
+        return handler
+
+    return _register
+
+class _LazyPformat:
+    def __init__(self, obj: object):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
 class GitHubWebhookReporter:
     logger = getLogger("GitHubWebhook")
-    router = Router()
 
     @staticmethod
     def handler(
-        func: Callable[[Event, Room], AsyncGenerator[str | tuple[str, int], int]]
-    ) -> Callable[[Event, "GitHubWebhookReporter"], Awaitable[None]]:
+        func: GeneratorHandler | CoroutineHandler
+    ) -> WebhookHandler:
+        # Handlers which only ever send one message are plain coroutines, and don't need
+        # the generator protocol to be driven
+        if not inspect.isasyncgenfunction(inspect.unwrap(func)):
+            coroutine_func = cast(CoroutineHandler, func)
+
+            @wraps(func)
+            async def _single_wrapper(event: Event, self: "GitHubWebhookReporter"):
+                match await coroutine_func(event, self.room):
+                    case None:
+                        pass
+                    case str(message):
+                        await self.room.send(message)
+                    case message:
+                        await self.room.send(*message)
+
+            return _single_wrapper
+
+        generator_func = cast(GeneratorHandler, func)
+
         @wraps(func)
         async def _wrapper(event: Event, self: "GitHubWebhookReporter"):
-            generator = func(event, self.room)
-            message = await anext(generator)
-            while True:
-                try:
+            generator = generator_func(event, self.room)
+            try:
+                message = await anext(generator)
+                while True:
                     if isinstance(message, str):
                         message_id = await self.room.send(message)
                     else:
                         message_id = await self.room.send(*message)
                     message = await generator.asend(message_id)
-                except StopAsyncIteration:
-                    break
+            except StopAsyncIteration:
+                pass
 
         return _wrapper
 
-    def __init__(self, room: Room, webhook_secret: str, ignored_repositories: set[str]):
+    def __init__(self, room: Room, webhook_secret: str, ignored_repositories: Iterable[str]):
         self.room = room
         self.webhook_secret = webhook_secret
-        self.ignored_repositories = ignored_repositories
+        self.ignored_repositories = frozenset(ignored_repositories)
+        self.interesting_events = frozenset(event for event, _ in ROUTES)
 
     async def handle_request(self, request: Request) -> Response:
         try:
@@ -50,33 +141,41 @@ class GitHubWebhookReporter:
         except (BadRequest, ValidationFailure):
             return Response(status=400)
         assert isinstance(event.data, dict)
+        if event.event not in self.interesting_events:
+            return Response(status=200)
         if repository := event.data.get("repository", False):
             if (
                 repository["visibility"] == "private"
                 or repository["name"] in self.ignored_repositories
             ):
                 return Response(status=200)
+        handler = ROUTES.get((event.event, event.data.get("action"))) or ROUTES.get((event.event, None))
+        if handler is None:
+            return Response(status=200)
         try:
-            await self.router.dispatch(event, self)
+            await handler(event, self)
         except Exception:
             self.logger.exception(
-                f"Failed to handle event {event.delivery_id} with payload:\n{pformat(event.data)}"
+                "Failed to handle event %s with payload:\n%s", event.delivery_id, _LazyPformat(event.data)
             )
             return Response(status=500)
         return Response(status=200)
 
-    @router.register("push")
+    @route("push")
     @handler
     @staticmethod
     async def on_push(event: Event, room: Room):
-        if event.data["ref"].split("/")[1] != "heads":
+        ref_parts = event.data["ref"].split("/", 2)
+        if ref_parts[1] != "heads":
             return
-        repository = repository_link(event.data["repository"])
-        ref = ref_link("/".join(event.data["ref"].split("/")[2:]), event.data["repository"])
+        repository_data = event.data["repository"]
+        sender_data = event.data["sender"]
+        repository = repository_link(repository_data)
+        ref = ref_link(ref_parts[2], repository_data)
         verb = "force-pushed" if event.data["forced"] else "pushed"
         pusher_name = event.data["pusher"]["name"]
-        if pusher_name == event.data["sender"]["login"]:
-            sender = user_link(event.data["sender"])
+        if pusher_name == sender_data["login"]:
+            sender = user_link(sender_data)
         else:
             sender = pusher_name
 
@@ -95,49 +194,32 @@ class GitHubWebhookReporter:
                 message = "(no title)"
             yield f"{sender} {verb} {len(commits)} commits to {ref} in {repository}: {message}"
     
-    @router.register("issues")
+    @route("issues")
     @handler
     @staticmethod
     async def on_issue(event: Event, room: Room):
+        sender_data = event.data["sender"]
+        action = event.data["action"]
         issue = issue_link(event.data["issue"])
-        sender = user_link(event.data["sender"])
+        sender = user_link(sender_data)
         repository = repository_link(event.data["repository"])
-        match event.data["action"]:
-            case "assigned" | "unassigned":
-                assignee = event.data["assignee"]
-                yield f"{sender} {event.data["action"]} {user_link(assignee)} to issue {issue} in {repository}"
-                if assignee["login"] == event.data["sender"]["login"]:
-                    yield "https://i.stack.imgur.com/1VzAJ.jpg"
-            case "closed":
-                yield f"{sender} closed issue {issue} as {event.data["issue"]["state_reason"]} in {repository}"
-            case "opened" | "reopened":
-                yield f"{sender} {event.data["action"]} issue {issue} in {repository}"
-
-    @router.register("pull_request")
+        if (formatter := ISSUE_ACTIONS.get(action)) is None:
+            return
+        yield formatter(event.data, sender, issue, repository)
+        if action in ("assigned", "unassigned") and event.data["assignee"]["login"] == sender_data["login"]:
+            yield "https://i.stack.imgur.com/1VzAJ.jpg"
+
+    @route("pull_request")
     @handler
     @staticmethod
     async def on_pull_request(event: Event, room: Room):
         pr = issue_link(event.data["pull_request"])
         sender = user_link(event.data["sender"])
         repository = repository_link(event.data["repository"])
-        match event.data["action"]:
-            case "assigned":
-                assignee = event.data["assignee"]
-                yield f"{sender} assigned {assignee} to pull request {pr} in {repository}"
-            case "unassigned":
-                assignee = event.data["assignee"]
-                yield f"{sender} unassigned {assignee} from pull request {pr} in {repository}"
-            case "closed":
-                yield (
-                    f"{sender} {"merged" if event.data["pull_request"]["merged"] else "closed"} "
-                    f"pull request {pr} in {repository}"
-                )
-            case "ready_for_review":
-                yield f"{sender} marked pull request {pr} in {repository} as ready for review"
-            case "opened" | "reopened" | "enqueued":
-                yield f"{sender} pull request {event.data["action"]} {pr} in {repository}"
-
-    @router.register("pull_request_review", action="submitted")
+        if (formatter := PULL_REQUEST_ACTIONS.get(event.data["action"])) is not None:
+            return formatter(event.data, sender, pr, repository)
+
+    @route("pull_request_review", action="submitted")
     @handler
     @staticmethod
     async def on_review_submitted(event: Event, room: Room):
@@ -145,56 +227,50 @@ class GitHubWebhookReporter:
         repository = repository_link(event.data["repository"])
         pr = issue_link(event.data["pull_request"])
         review = event.data["review"]
-        match review["state"]:
-            case "commented":
-                if not len(review["body"]):
-                    return
-                action = "commented on"
-            case "approved":
-                action = "approved"
-            case "changes_requested":
-                action = "requested changes on"
-            case _:
-                return
-        yield (
+        body = review["body"]
+        state = review["state"]
+        # empty comment reviews are usually just containers for line comments
+        if (action := REVIEW_ACTIONS.get(state)) is None or (state == "commented" and not len(body)):
+            return
+        return (
             f"{sender} [{action}]({review["html_url"]}) {pr} in {repository}"
-            f"{f": \"{escape_markdown(review["body"].splitlines()[0])}\"" if len(review["body"]) else ""}"
+            f"{f": \"{escape_markdown(body.splitlines()[0])}\"" if len(body) else ""}"
         )
     
-    @router.register("create")
-    @router.register("delete")
+    @route("create")
+    @route("delete")
     @handler
     @staticmethod
     async def on_ref_change(event: Event, room: Room):
         sender = user_link(event.data["sender"])
         repository = repository_link(event.data["repository"])
-        yield f"{sender} {event.event}d {event.data["ref_type"]} {event.data["ref"]} in {repository}"
+        return f"{sender} {event.event}d {event.data["ref_type"]} {event.data["ref"]} in {repository}"
 
-    @router.register("release", action="released")
+    @route("release", action="released")
     @handler
     @staticmethod
     async def on_release(event: Event, room: Room):
         release = event.data["release"]
         release_name = release["name"].lower()
         # attempt to match version number, otherwise default to the whole name
-        if match := re.search(r"\d.*", release_name):
+        if match := VERSION_REGEX.search(release_name):
             release_name = match[0]
 
-        yield f"__[{event.data["repository"]["name"]} {release_name}]({release["html_url"]})__"
+        return f"__[{event.data["repository"]["name"]} {release_name}]({release["html_url"]})__"
 
-    @router.register("fork")
+    @route("fork")
     @handler
     @staticmethod
     async def on_fork(event: Event, room: Room):
         sender = user_link(event.data["sender"])
         repository = repository_link(event.data["repository"])
         forkee = repository_link(event.data["forkee"])
-        yield f"{sender} forked {forkee} from {repository}"
+        return f"{sender} forked {forkee} from {repository}"
 
-    @router.register("repository")
+    @route("repository")
     @handler
     @staticmethod
     async def on_repository(event: Event, room: Room):
         sender = user_link(event.data["sender"])
         repository = repository_link(event.data["repository"])
-        yield f"{sender} {event.data["action"]} repository {repository}"
\ No newline at end of file
+        return f"{sender} {event.data["action"]} repository {repository}"
\ No newline at end of file